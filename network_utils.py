@@ -1,12 +1,17 @@
 import networkx as nx
 # from scipy.stats import poisson
-import itertools
-from tqdm import tqdm
 # from seirsplus.models import *
 import pandas as pd
 import numpy as np
 from collections import defaultdict
 import pickle as pkl
+import os
+import warnings
+from types import MappingProxyType
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from dataclasses import dataclass
+from scipy import sparse
 
 STATE_DICTIONARY = {
     "Susceptible": 1,
@@ -22,112 +27,249 @@ STATE_DICTIONARY = {
     "Detected_Symptomatic": 11,
     "Detected_Asymptomatic": 12}
 
+# Random generator shared by the network functions when they aren't given one
+_rng = np.random.default_rng()
+
+
+def _get_rng(rng=None):
+    """ Returns the generator to use for a given rng argument: the shared generator if it is None, or a
+        numpy Generator for it otherwise (either the Generator itself, or a new one if it is a seed) """
+    return _rng if rng is None else np.random.default_rng(rng)
+
 
 # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
 # Network creation utils
 # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+@dataclass
+class EdgeList:
+    """ Edges stored as parallel arrays, where edge i goes from src[i] to dst[i] and has weight[i] and label[i].
+        Labels are stored as uint8 codes, where label_names[label[i]] is the label of edge i.
+        The network creation functions build their edges in one of these and only turn them into a networkX
+        graph at the end """
+    src: np.ndarray
+    dst: np.ndarray
+    weight: np.ndarray
+    label: np.ndarray
+    label_names: tuple
+
+    @classmethod
+    def from_arrays(cls, src, dst, weight, label):
+        """ Creates an edge list where all the edges between src and dst share the same weight and label """
+        src = np.asarray(src, dtype=np.int32)
+        return cls(src=src,
+                   dst=np.asarray(dst, dtype=np.int32),
+                   weight=np.full(len(src), weight, dtype=float),
+                   label=np.zeros(len(src), dtype=np.uint8),
+                   label_names=(label,))
+
+    @classmethod
+    def concatenate(cls, edge_lists):
+        """ Joins a list of edge lists into a single one """
+        edge_lists = list(edge_lists)
+        if not edge_lists:
+            return cls.from_arrays([], [], 0, "")
+
+        # Merge the label names of all the edge lists, and translate the label codes of each one to them
+        label_names = tuple(dict.fromkeys(name for edges in edge_lists for name in edges.label_names))
+        labels = [np.array([label_names.index(name) for name in edges.label_names], dtype=np.uint8)[edges.label]
+                  for edges in edge_lists]
+
+        return cls(src=np.concatenate([edges.src for edges in edge_lists]),
+                   dst=np.concatenate([edges.dst for edges in edge_lists]),
+                   weight=np.concatenate([edges.weight for edges in edge_lists]),
+                   label=np.concatenate(labels),
+                   label_names=label_names)
+
+    def __len__(self):
+        return len(self.src)
+
+    def buckets(self):
+        """ Returns the edges grouped by their attributes, as a {(weight, label): [(src, dst), ...]} dict """
+        buckets = dict()
+        for code, label in enumerate(self.label_names):
+            label_mask = self.label == code
+            src, dst, weights = self.src[label_mask], self.dst[label_mask], self.weight[label_mask]
+
+            for weight in np.unique(weights).tolist():
+                mask = weights == weight
+                buckets[(weight, label)] = list(zip(src[mask].tolist(), dst[mask].tolist()))
+
+        return buckets
+
+    def to_networkx(self, graph=None):
+        """ Adds the edges to the given networkX graph (or to a new one), one call per (weight, label).
+            Like in networkX, edges that are already in the graph get their attributes overwritten """
+        if graph is None:
+            graph = nx.Graph()
+
+        flush_edges(graph, self.buckets())
+
+        return graph
+
+    def to_csr(self, n_nodes=None):
+        """ Returns the symmetric weighted adjacency matrix of the edges as a scipy CSR matrix.
+            If an edge appears more than once, the weight of its last occurrence is kept """
+        if n_nodes is None:
+            n_nodes = int(max(self.src.max(initial=-1), self.dst.max(initial=-1))) + 1
+
+        # Drop duplicate edges, in either direction, keeping their last occurrence
+        low, high = np.minimum(self.src, self.dst).astype(np.int64), np.maximum(self.src, self.dst).astype(np.int64)
+        _, last = np.unique((low * n_nodes + high)[::-1], return_index=True)
+        keep = len(self) - 1 - last
+
+        rows = np.concatenate([low[keep], high[keep]])
+        cols = np.concatenate([high[keep], low[keep]])
+        weights = np.concatenate([self.weight[keep], self.weight[keep]])
+
+        return sparse.csr_matrix((weights, (rows, cols)), shape=(n_nodes, n_nodes))
+
+
+def flush_edges(graph, buckets):
+    """ Adds the edges in a {(weight, label): [(src, dst), ...]} dict to the graph, with a single add_edges_from
+        call per (weight, label), so that the attributes are passed once for all the edges that share them
+        instead of as a dict per edge """
+    for (weight, label), edges in buckets.items():
+        graph.add_edges_from(edges, weight=weight, label=label)
+
+
 def create_graph(
         n_structures,
         start_idx,
         population,
         max_pop_per_struct,
+        rng=None,
+        neighbor_grids=(),
         **kwargs):
     """ Creates a networkX graph containing all the population in the camp that is in a given structure (currently just isoboxes).
         Draws edges between people from the same isobox and returns the networkX graph and an adjacency list
+        rng can be a seed or a numpy Generator, to get reproducible graphs
+        If neighbor_grids is given, people of neighboring structures in each of those grids are also connected, like
+        connect_neighbors does (with the proximity, neighbor_weight and neighbor_label kwargs), so that the whole
+        graph is built at once instead of being copied for every grid
     """
+    rng = _get_rng(rng)
+
+    nodes = np.arange(start_idx, population)
+
+    # Lay out one slot per bed of every isobox and shuffle them, so that taking the first len(nodes) slots
+    # assigns every node to a random isobox without going over its capacity. An isobox only stops taking
+    # people once it goes over max_pop_per_struct, so each one has max_pop_per_struct + 1 beds
+    slots = np.repeat(np.arange(n_structures, dtype=np.int32), np.asarray(max_pop_per_struct) + 1)
+    if len(slots) < len(nodes):
+        raise ValueError(f"Cannot fit {len(nodes)} people in structures with room for {len(slots)}")
+
+    rng.shuffle(slots)
+    struct_nums = slots[:len(nodes)]
 
-    # Graph is a networkX graph object
-    g = nx.Graph()
+    # Draw the ethnicity of every node at once
+    ethnicities = rng.integers(0, kwargs["n_ethnicities"], size=len(nodes))
 
-    # Keep track of how many nodes we have put in an isobox already
-    struct_count = np.zeros(shape=n_structures)
+    # The location and ethnicity of every node are stored as arrays indexed by node in the graph attributes,
+    # see get_node_properties
+    locations = np.zeros(population, dtype=np.uint32)
+    locations[nodes] = struct_nums
+    node_ethnicities = np.zeros(population, dtype=np.uint8)
+    node_ethnicities[nodes] = ethnicities
 
     # Store the indices of the nodes we store in each isobox in a 2D array
     # where array[i] contains the nodes in isobox i
-    nodes_per_struct = [[] for i in range(n_structures)]
-
-    available_structs = list(range(n_structures))
-
-    # Add the nodes to the graph
-    for node in tqdm(range(start_idx, population)):
-        g.add_node(node)
-
-        # Assign nodes to isoboxes randomly, until we reach the capacity of
-        # that isobox
-        struct_num = np.random.choice(available_structs)
-
-        # Assign properties to nodes
-        g.nodes[node]["age"] = kwargs["age_list"][node]
-        g.nodes[node]["sex"] = kwargs["sex_list"][node]
-        g.nodes[node]["location"] = struct_num
-        g.nodes[node]["ethnicity"] = np.random.choice(
-            range(kwargs["n_ethnicities"]))
-
-        # Update number of nodes per isobox and which nodes were added to
-        # iso_num
-        struct_count[struct_num] += 1
-        nodes_per_struct[struct_num].append(node)
-
-        if struct_count[struct_num] > max_pop_per_struct[struct_num]:
-            available_structs.remove(struct_num)
-
-    # Now we connect nodes inside of the same isobox
-    for node_list in nodes_per_struct:
-        # Use the cartesian product to get all possible edges within the nodes in an isobox
-        # and only add if they are not the same node
-        edge_list = [
-            tup for tup in list(
-                itertools.product(
-                    node_list,
-                    repeat=2)) if tup[0] != tup[1]]
-        g.add_edges_from(
-            edge_list,
-            weight=kwargs["edge_weight"],
-            label=kwargs["label"])
+    order = np.argsort(struct_nums, kind="stable")
+    struct_nodes = nodes[order].astype(np.int32)
+    struct_sizes = np.bincount(struct_nums, minlength=n_structures)
+    struct_starts = np.cumsum(struct_sizes) - struct_sizes
+    nodes_per_struct = [node_list.tolist() for node_list in np.split(struct_nodes, struct_starts[1:])]
+
+    # Now we connect nodes inside of the same isobox. Every pair of nodes in an isobox is connected, so we
+    # build the edges of all the isoboxes with the same number of people at once, as rows of a matrix
+    src, dst = [], []
+    for size in np.unique(struct_sizes[struct_sizes > 1]).tolist():
+        members = struct_nodes[struct_starts[struct_sizes == size][:, np.newaxis] + np.arange(size)]
+
+        # The graph is undirected, so each pair only has to be generated once
+        i, j = np.triu_indices(size, k=1)
+        src.append(members[:, i].ravel())
+        dst.append(members[:, j].ravel())
+
+    edge_lists = [EdgeList.from_arrays(np.concatenate(src or [[]]), np.concatenate(dst or [[]]),
+                                       kwargs["edge_weight"], kwargs["label"])]
+
+    # Connect people from neighboring structures in every grid
+    for grid in neighbor_grids:
+        edge_lists.append(neighbor_edges(node_ethnicities, int(grid[0][0]), grid.size, nodes_per_struct, grid,
+                                         kwargs["proximity"], kwargs["neighbor_weight"], kwargs["neighbor_label"]))
+
+    # Graph is a networkX graph object, which we build in one go with the nodes along with their properties,
+    # and then all of the edges
+    g = nx.Graph(location=locations, ethnicity=node_ethnicities)
+    g.add_nodes_from(zip(nodes.tolist(),
+                         [{"age": kwargs["age_list"][node], "sex": kwargs["sex_list"][node]}
+                          for node in nodes.tolist()]))
+    EdgeList.concatenate(edge_lists).to_networkx(g)
 
     return g, nodes_per_struct
 
 
-def remove_edges_from_graph(base_graph, edge_label_list, scale, min_num_edges):
+def remove_edges_from_graph(base_graph, edge_label_list, scale, min_num_edges, inplace=False, rng=None):
     """ Randomly remove some of the edges that have a label included in the label list (i.e 'food', 'neighbors', etc)
         The scale is a parameter for the exponential distribution and the min_num_edges the minimum number of edges
-        a node should keep (this will be the peak of the distribution) """
+        a node should keep (this will be the peak of the distribution)
+        If inplace=True the edges are removed from base_graph itself instead of from a new graph
+        rng can be a seed or a numpy Generator, to get reproducible graphs """
+    rng = _get_rng(rng)
 
-    graph = base_graph.copy()
+    edge_label_set = set(edge_label_list)
+
+    # Find the neighbors that share an edge of a particular label with each node in a single pass over the edges
+    eligible_neighbors = defaultdict(list)
+    for u, v, label in base_graph.edges(data="label"):
+        if label in edge_label_set:
+            eligible_neighbors[u].append(v)
+            eligible_neighbors[v].append(u)
+
+    # Edges to remove, stored as (neighbor, node) so that they can be looked up when we get to the neighbor
+    removed_edges = set()
+
+    # Randomly draw the number of edges to keep for every node at once
+    keep_edge_nums = rng.exponential(scale=scale, size=base_graph.number_of_nodes())
 
-    for node in graph:
-        # Select all the neighbors that share an edge of a particular label
-        neighbors = [neighbor for neighbor in list(graph[node].keys())
-                     if graph.edges[node, neighbor]["label"] in edge_label_list]
+    for node, keep_edge_num in zip(base_graph, keep_edge_nums):
+        # Select the neighbors whose edge hasn't been removed yet
+        neighbors = [neighbor for neighbor in eligible_neighbors[node] if (node, neighbor) not in removed_edges]
 
         # If there are no neighbors that have a label from edge_label_list, we
         # continue
         if neighbors:
-            # Randomly draw the number of edges to keep
-            quarantine_edge_num = int(max(min(np.random.exponential(
-                scale=scale, size=1), len(neighbors)), min_num_edges))
+            quarantine_edge_num = int(max(min(keep_edge_num, len(neighbors)), min_num_edges))
 
             if quarantine_edge_num <= len(neighbors):
-                # Create the list of neighbors to keep
-                quarantine_keep_neighbors = np.random.choice(
-                    neighbors, size=quarantine_edge_num, replace=True)
+                # Create the set of neighbors to keep, drawing them with replacement
+                quarantine_keep_neighbors = {neighbors[i] for i in
+                                             rng.integers(0, len(neighbors), size=quarantine_edge_num)}
 
                 # Remove edges that are not in te list of neighbors to keep
                 for neighbor in neighbors:
                     if neighbor not in quarantine_keep_neighbors:
-                        graph.remove_edge(node, neighbor)
+                        removed_edges.add((neighbor, node))
+
+    if inplace:
+        base_graph.remove_edges_from(removed_edges)
+        return base_graph
+
+    # Only copy over the edges that are kept, instead of copying the whole graph and removing them afterwards
+    graph = nx.create_empty_copy(base_graph)
+    graph.add_edges_from((u, v, data) for u, v, data in base_graph.edges(data=True)
+                         if (u, v) not in removed_edges and (v, u) not in removed_edges)
 
     return graph
 
 
 def remove_all_edges(base_graph, edge_label_list):
     graph = base_graph.copy()
-    for node in graph:
-        neighbors = [neighbor for neighbor in list(graph[node].keys())
-                     if graph.edges[node, neighbor]["label"] in edge_label_list]
+    edge_label_set = set(edge_label_list)
 
-        for neighbor in neighbors:
-            graph.remove_edge(node, neighbor)
+    # The adjacency of each node already holds the data of its edges, so there's no need to look them up again
+    graph.remove_edges_from([(node, neighbor) for node, adjacency in graph.adj.items()
+                             for neighbor, data in adjacency.items() if data.get("label") in edge_label_set])
 
     return graph
 
@@ -141,15 +283,7 @@ def create_grid(width, height, starting_n):
     """ Create a grid of isoboxes that resembles the isobox area of the camp, for ease of measuring proximity
         between nodes. Returns a numpy array of shape (width, height) """
 
-    grid = np.zeros(shape=(width, height)).astype(int)
-    n = starting_n
-
-    for i in range(width):
-        for j in range(height):
-            grid[i][j] = n
-            n += 1
-
-    return grid
+    return np.arange(starting_n, starting_n + width * height, dtype=np.int32).reshape(width, height)
 
 
 def get_neighbors(grid, structure_num, proximity):
@@ -165,22 +299,120 @@ def get_neighbors(grid, structure_num, proximity):
     """
 
     # Get the number of columns for ease of access
-    width = len(grid)
-    height = len(grid[0])
+    height = grid.shape[1]
+
+    # Position of the structure in the grid, counting from the first structure in it
+    row, col = divmod(structure_num - grid[0][0], height)
+
+    # Take the block of structures around it, clipped to the edges of the grid. Both ends are clipped, so a
+    # structure that lies outside the grid only gets the part of its block that overlaps with it, if any
+    neighbors = grid[max(row - proximity, 0):max(row + proximity + 1, 0),
+                     max(col - proximity, 0):max(col + proximity + 1, 0)].ravel()
+
+    return neighbors[neighbors != structure_num].tolist()
+
+
+def precompute_neighbor_table(grid, proximity):
+    """ Returns a read-only mapping from every structure in the grid to an array of its closest proximity neighbors,
+        as given by get_neighbors. The most recent tables are cached, so the graph variants built from the same grid
+        share them """
+    return MappingProxyType(_cached_neighbor_table(grid, proximity))
+
+
+def _cached_neighbor_table(grid, proximity):
+    # The cached dict itself is only used inside this module, everyone else gets a read-only view of it
+    return _neighbor_table(grid.tobytes(), grid.shape, grid.dtype.str, proximity)
+
+
+# A camp only has a handful of grids and proximities, so this keeps all of them without growing forever
+@lru_cache(maxsize=32)
+def _neighbor_table(grid_bytes, shape, dtype, proximity):
+    grid = np.frombuffer(grid_bytes, dtype=dtype).reshape(shape)
+
+    neighbor_table = dict()
+    for structure_num in grid.ravel().tolist():
+        neighbors = np.asarray(get_neighbors(grid, structure_num, proximity), dtype=np.int32)
+        # The table is shared between calls, so make sure nobody edits it
+        neighbors.flags.writeable = False
+        neighbor_table[structure_num] = neighbors
+
+    return neighbor_table
+
+
+def _match_ethnicities(nodes, node_ethnicities, other_nodes, other_ethnicities):
+    """ Returns the (src, dst) arrays of every pair of a node in nodes and a node in other_nodes that share the
+        same ethnicity """
+    i, j = np.nonzero(node_ethnicities[:, np.newaxis] == other_ethnicities[np.newaxis, :])
+    return nodes[i], other_nodes[j]
+
 
-    # We'll make it a set initially to avoid duplicate neighbors
-    neighbors = set()
+def _neighbor_edges(structures, all_structures, structure_nodes, ethnicities, grid, proximity, neighbor_table):
+    """ Returns the (src, dst) arrays of the friendship edges of the given structures, which are part of
+        all_structures (the structures being connected by connect_neighbors) """
+    src, dst = [], []
 
-    for i in range(-proximity, proximity + 1):
-        for j in range(-proximity, proximity + 1):
-            if not (i == 0 and j == 0):
-                x = min(max((structure_num // height) - i, 0), width - 1)
-                y = min(max((structure_num % height) - j, 0), height - 1)
+    # For every possible structure:
+    for structure in structures:
+
+        # Given an isobox number get its neighbor isoboxes. Structures outside the grid (when start_idx doesn't
+        # match it) aren't in the table, and only get the grid structures that fall inside their proximity block
+        if structure in neighbor_table:
+            neighbors = neighbor_table[structure]
+
+            # Neighborhoods are symmetric inside the grid, so the edges with neighbors that are also being
+            # connected are only drawn from the lowest numbered structure
+            neighbors = neighbors[(neighbors > structure) | (neighbors < all_structures.start)
+                                  | (neighbors >= all_structures.stop)]
+        else:
+            # The neighbors of a structure outside the grid don't list it back, so keep all of them
+            neighbors = np.asarray(get_neighbors(grid, structure, proximity), dtype=np.int32)
+
+        if not len(neighbors):
+            continue
+
+        # Draw an edge between everyone that shares the same ethnicity with someone in a neighbor isobox
+        nodes = structure_nodes[structure]
+        neighbor_nodes = np.concatenate([structure_nodes[neighbor] for neighbor in neighbors])
+        node_src, node_dst = _match_ethnicities(nodes, ethnicities[nodes], neighbor_nodes, ethnicities[neighbor_nodes])
+        src.append(node_src)
+        dst.append(node_dst)
+
+    return np.concatenate(src or [[]]).astype(np.int32), np.concatenate(dst or [[]]).astype(np.int32)
+
+
+def neighbor_edges(
+        ethnicities,
+        start_idx,
+        n_structures,
+        nodes_per_structure,
+        grid,
+        proximity,
+        edge_weight,
+        label,
+        n_jobs=1):
+    """ Returns an EdgeList with the edges between people of neighboring structures (currently isoboxes) if they
+        have the same ethnicity, where ethnicities[i] is the ethnicity of node i
+        With n_jobs > 1 the structures are split between that many processes (-1 to use all the CPUs) """
 
-                if grid[x][y] != structure_num:
-                    neighbors.add(grid[x][y])
+    structure_nodes = [np.asarray(node_list, dtype=np.int32) for node_list in nodes_per_structure]
+    structures = range(start_idx, n_structures + start_idx)
 
-    return list(neighbors)
+    find_edges = partial(_neighbor_edges, all_structures=structures, structure_nodes=structure_nodes,
+                         ethnicities=ethnicities, grid=grid, proximity=proximity,
+                         neighbor_table=_cached_neighbor_table(grid, proximity))
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+
+    if n_jobs > 1:
+        # Every process builds the edges of a block of structures, which are joined afterwards
+        blocks = [range(block[0], block[-1] + 1) for block in np.array_split(structures, n_jobs) if len(block)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(find_edges, blocks))
+    else:
+        results = [find_edges(structures)]
+
+    return EdgeList.concatenate([EdgeList.from_arrays(src, dst, edge_weight, label) for src, dst in results])
 
 
 def connect_neighbors(
@@ -191,64 +423,63 @@ def connect_neighbors(
         grid,
         proximity,
         edge_weight,
-        label):
+        label,
+        inplace=False,
+        n_jobs=1):
     """ Draw edges in the given graph between people of neighboring structures (currently isoboxes)
-        f they have the same ethnicity """
-
-    graph = base_graph.copy()
-
-    # For every possible structure:
-    for structure in range(start_idx, n_structures + start_idx):
+        f they have the same ethnicity
+        If inplace=True the edges are added to base_graph itself instead of to a copy of it
+        With n_jobs > 1 the structures are split between that many processes (-1 to use all the CPUs) """
 
-        # Given an isobox number get its neighbor isoboxes
-        neighbors = get_neighbors(grid, structure, proximity)
+    graph = base_graph if inplace else base_graph.copy()
 
-        # For every neighbor isobox:
-        for neighbor in neighbors:
-            # If they share the same properties, draw an edge between them
-            graph.add_edges_from([(i, j) for i in nodes_per_structure[structure]
-                                  for j in nodes_per_structure[neighbor] if
-                                  graph.nodes[i]["ethnicity"] == graph.nodes[j]["ethnicity"]],
-                                 weight=edge_weight, label=label)
+    edges = neighbor_edges(get_node_properties(graph, "ethnicity"), start_idx, n_structures, nodes_per_structure,
+                           grid, proximity, edge_weight, label, n_jobs=n_jobs)
+    edges.to_networkx(graph)
 
     return graph
 
 
-def connect_food_queue(base_graph, nodes_per_structure, edge_weight, label):
+def connect_food_queue(base_graph, nodes_per_structure, edge_weight, label, inplace=False, rng=None):
     """ Connect 1-2 people per structure (currently just isoboxes) randomly to represent that they go to the food queue
         We have 3 options:
             - Either have a range of people (2-5 per isobox) that go to food queue, same edge weights
             - Connect all people in the food queue, same edge weights
             - Connect all people in food queue with different edge weights
+        If inplace=True the edges are added to base_graph itself instead of to a copy of it
+        rng can be a seed or a numpy Generator, to get reproducible graphs
     """
+    rng = _get_rng(rng)
 
-    graph = base_graph.copy()
+    graph = base_graph if inplace else base_graph.copy()
 
-    food_bois = set()
+    # This list represents the food queue
+    food_bois = []
 
     # Choose half of the people randomly from each structure
     for node_list in nodes_per_structure:
-        for i in range(len(node_list) // 2):
-            food_bois.add(np.random.choice(node_list))
+        food_bois.extend(rng.choice(node_list, size=len(node_list) // 2, replace=False).tolist())
 
-    # This list represents the food queue
-    food_bois = list(food_bois)
-    np.random.shuffle(food_bois)
+    rng.shuffle(food_bois)
 
-    # Draw an edge between everyone in the list in order, since we have
+    # Draw an edge between everyone in the list and the five people behind them, since we have
     # already shuffled them
-    for i in range(len(food_bois) - 6):
-        for j in range(i + 1, i + 6):
-            if not graph.has_edge(food_bois[i], food_bois[j]):
-                graph.add_edge(
-                    food_bois[i],
-                    food_bois[j],
-                    weight=edge_weight,
-                    label=label)
+    food_bois = np.asarray(food_bois, dtype=int)
+    queue_edges = np.concatenate([np.stack([food_bois[:-k], food_bois[k:]], axis=1) for k in range(1, 6)])
+
+    # People that were already connected (i.e. from the same household) keep their original edge
+    is_new_edge = np.array([not graph.has_edge(u, v) for u, v in queue_edges.tolist()], dtype=bool)
+    queue_edges = queue_edges[is_new_edge]
+
+    edges = EdgeList.from_arrays(queue_edges[:, 0], queue_edges[:, 1], edge_weight, label)
+    edges.to_networkx(graph)
+
     return graph
 
 
-def create_multiple_food_queues(base_graph, n_food_queues_per_block, food_weight, nodes_per_struct, grids):
+def create_multiple_food_queues(base_graph, n_food_queues_per_block, food_weight, nodes_per_struct, grids, rng=None):
+    # Every queue draws from the same generator, so that a seed doesn't give them all the same draws
+    rng = _get_rng(rng)
     graph = base_graph.copy()
     queue_num = 0
 
@@ -268,7 +499,9 @@ def create_multiple_food_queues(base_graph, n_food_queues_per_block, food_weight
             nodes_per_struct_subgrid = [nodes_per_struct[subgrid[i][j]] for i in range(len(subgrid)) for j in
                                         range(len(subgrid[i]))]
 
-            graph = connect_food_queue(graph, nodes_per_struct_subgrid, food_weight, f"food_{queue_num}")
+            # The graph is already a copy of base_graph, so there is no need to copy it again for every queue
+            graph = connect_food_queue(graph, nodes_per_struct_subgrid, food_weight, f"food_{queue_num}",
+                                       inplace=True, rng=rng)
             queue_num += 1
 
     return graph
@@ -301,20 +534,49 @@ def create_node_groups(graph):
 # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
 # Network helper functions
 # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+def _degree_array(graph):
+    """ Return the degree of every node in the graph as an array """
+    return np.fromiter((degree for _, degree in graph.degree()), dtype=np.int32, count=graph.number_of_nodes())
+
+
 def min_degree(graph):
     """ Return the minimum degree in the graph """
-    return min(graph.degree, key=lambda kv: kv[1])[1]
+    return int(_degree_array(graph).min())
 
 
 def max_degree(graph):
     """ Return the maximum degree in the graph """
-    return max(graph.degree, key=lambda kv: kv[1])[1]
+    return int(_degree_array(graph).max())
 
 
-def get_nodes_per_state(X, graph, state):
+def get_nodes_per_state(X, state, *args, graph=None):
     """ Get the nodes that have a given state in the latest timestep of the SEIRS+ model
-        Since nodes are represented by their properties in this case, this will return a list of property dicts """
-    return [node for node in graph.nodes if X[node] == state]
+        X is the state vector of the model (model.X, or one of the node_states stored by run_simulation). Node i
+        is assumed to be row i of X, which holds for the graphs made by create_graph since their nodes are numbered
+        0 to n - 1 in order. Returns an array with the nodes, whose properties can be looked up with
+        get_node_properties
+        The old get_nodes_per_state(X, graph, state) form still works, but is deprecated since the graph isn't used """
+    if isinstance(state, nx.Graph) or graph is not None:
+        warnings.warn("get_nodes_per_state(X, graph, state) is deprecated, call get_nodes_per_state(X, state) instead",
+                      DeprecationWarning, stacklevel=2)
+        if isinstance(state, nx.Graph):
+            state = args[0]
+
+    return np.flatnonzero(np.ravel(X) == state)
+
+
+def get_node_properties(graph, property_name):
+    """ Returns an array with the given property (i.e. 'ethnicity' or 'location') of every node, where array[i] is
+        the value for node i. Graphs made by create_graph keep these arrays in their graph attributes, while older
+        graphs store them in each node's properties """
+    if property_name in graph.graph:
+        return graph.graph[property_name]
+
+    properties = np.zeros(max(graph.nodes) + 1, dtype=np.uint32)
+    for node, value in graph.nodes(data=property_name):
+        properties[node] = value
+
+    return properties
 
 
 def save_graph(graph, nodes_per_struct, name):